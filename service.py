@@ -2,69 +2,162 @@
 
 import os
 import io
+import functools
 import sys
 import shutil
 import subprocess
 import time
+import argparse
+import shlex
 
-import click
 import ruamel.yaml as ryaml
 import jinja2
 
 HERE = os.path.abspath(os.path.dirname(__file__))
+PYTHON_BINDIR = os.path.abspath(os.path.dirname(sys.executable))
+
+GUNICORN_TEMPLATE_PATH = os.path.join('services', 'templates', 'systemd.gunicorn.service')
+CELERY_TEMPLATE_PATH = os.path.join('services', 'templates', 'systemd.celery.service')
+GUNICORN_CONFIG_PATH = os.path.join(HERE, 'services', 'gunicorn_config.py')
+
+
+class BestEffortBytecodeCache(jinja2.FileSystemBytecodeCache):
+    """Bytecode cache that silently skips caching when it can not be read or written"""
+
+    def load_bytecode(self, bucket):
+        try:
+            super().load_bytecode(bucket)
+        except OSError:
+            pass
+
+    def dump_bytecode(self, bucket):
+        try:
+            super().dump_bytecode(bucket)
+        except OSError:
+            pass
+
+
+def make_bytecode_cache():
+    # default directory is per-user one in system temp dir,
+    # so running with sudo never leaves root-owned files in the source tree
+    try:
+        return BestEffortBytecodeCache()
+    except (OSError, RuntimeError):
+        return None
+
+
+_JINJA_ENV = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(HERE),
+    undefined=jinja2.StrictUndefined,
+    auto_reload=False,
+    cache_size=-1,
+    bytecode_cache=make_bytecode_cache(),
+)
 
 
 def print_error(*args):
     print('ERROR:', *args, file=sys.stderr)
 
 
+@functools.lru_cache(maxsize=32)
+def _load_descriptor_cached(filepath, mtime):
+    # mtime is part of the cache key only, so edited descriptors get reloaded;
+    # returned structure is shared between calls and must not be mutated
+    # safe loader yields plain dicts/lists and uses libyaml when available,
+    # falling back to the pure Python implementation otherwise
+    yaml = ryaml.YAML(typ='safe', pure=False)
+    with io.open(filepath, encoding='utf-8') as f:
+        return yaml.load(f)
+
+
+DESCRIPTOR_PEEK_SIZE = 4096  # byte(s)
+
+
+def descriptor_path(service):
+    return os.path.join(HERE, 'services', f'{service}.yaml')
+
+
+def peek_descriptor(service, config):
+    """Check that config is defined for service without loading whole descriptor"""
+    service_descriptor_filepath = descriptor_path(service)
+    try:
+        with io.open(service_descriptor_filepath, 'rb') as f:
+            head = f.read(DESCRIPTOR_PEEK_SIZE)
+            complete = not f.read(1)
+    except Exception as e:
+        return None, f'Failed to load descriptor for service [{service}]: {e}'
+    if not complete:
+        # cut at line boundary to not break scalar or UTF-8 sequence in the middle
+        head = head[:head.rfind(b'\n') + 1]
+        yaml = ryaml.YAML(typ='safe', pure=False)
+        try:
+            descriptor = yaml.load(head.decode('utf-8'))
+        except Exception:
+            descriptor = None
+        if isinstance(descriptor, dict) and config in (descriptor.get('configs') or {}):
+            return None, None
+    # whole descriptor fits in header or header was not enough
+    __, error = load_settings(service, config)
+    return None, error
+
+
 def load_settings(service, config):
-    service_descriptor_filepath = os.path.join(HERE, 'services', '{}.yaml'.format(service))
-    yaml = ryaml.YAML()
+    service_descriptor_filepath = descriptor_path(service)
     try:
-        with io.open(service_descriptor_filepath, encoding='utf-8') as f:
-            descriptor = yaml.load(f)
+        mtime = os.path.getmtime(service_descriptor_filepath)
+        descriptor = _load_descriptor_cached(service_descriptor_filepath, mtime)
     except Exception as e:
-        return None, 'Failed to load descriptor for service [{}]: {}'.format(service, e)
+        return None, f'Failed to load descriptor for service [{service}]: {e}'
     else:
         if not descriptor or 'configs' not in descriptor:
             return None, 'Service descriptor invalid or empty'
         if config not in descriptor['configs']:
-            return None, 'Config definition not found: {}'.format(config)
+            return None, f'Config definition not found: {config}'
+
+        mapping = {'service': service, 'config': config}
 
         def deep_format(obj):
-            if isinstance(obj, dict):
-                return {k: deep_format(v) for k, v in obj.items()}
-            if isinstance(obj, str):
-                return obj.format(service=service, config=config)
-            return obj
-
-        settings_common = descriptor.get('common', {})
-        settings = deep_format(settings_common)
-        settings.update(descriptor['configs'][config] or {})
-        settings['SERVICE'] = service
-        settings['CONFIG'] = config
-        settings['HOME'] = HERE
-        settings['PYTHON_CMD'] = sys.executable
-        settings['LOGGING_DIR'] = '/var/log/example'
+            # iterative copy of nested dicts/lists with placeholders substituted in strings
+            result = [obj]
+            stack = [(result, 0)]
+            while stack:
+                container, key = stack.pop()
+                value = container[key]
+                if isinstance(value, dict):
+                    value = dict(value)
+                    stack.extend((value, k) for k in value)
+                elif isinstance(value, list):
+                    value = list(value)
+                    stack.extend((value, i) for i in range(len(value)))
+                elif isinstance(value, str) and '{' in value:
+                    value = value.format_map(mapping)
+                container[key] = value
+            return result[0]
+
+        settings_common = descriptor.get('common') or {}
+        settings = {
+            **deep_format(settings_common),
+            **(descriptor['configs'][config] or {}),
+            'SERVICE': service,
+            'CONFIG': config,
+            'HOME': HERE,
+            'PYTHON_CMD': sys.executable,
+            'LOGGING_DIR': '/var/log/example',
+        }
         # settings['env']['LOG_CONFIG'] = os.path.join(os.getcwd(), 'services', 'logging', '{}.yaml'.format(settings['logconfig']))
         env_prefix = descriptor.get('env_prefix')
         if env_prefix:
-            settings['env'] = {'{}_{}'.format(env_prefix, k): v for k, v in settings['env'].items()}
+            settings['env'] = {f'{env_prefix}_{k}': v for k, v in settings['env'].items()}
         return settings, None
 
 
 def render_template(localpath, context):
-    loader = jinja2.FileSystemLoader(HERE)
-    env = jinja2.Environment(loader=loader)
-    env.undefined = jinja2.StrictUndefined
-    template = env.get_template(localpath)
-    result = template.render(context)
-    return result
+    template = _JINJA_ENV.get_template(localpath)
+    return template.render(context)
 
 
 def derive_systemd_name(service, config):
-    return 'example.{}.{}.service'.format(service, config)
+    return f'example.{service}.{config}.service'
 
 
 def systemd_service_path(service_name):
@@ -75,94 +168,156 @@ def systemd_install(service_name, service_def):
     systemd_path = systemd_service_path(service_name)
     try:
         with io.open(systemd_path, 'w', encoding='utf-8') as ostream:
-            shutil.copyfileobj(io.StringIO(service_def), ostream)
-        subprocess.run('systemctl daemon-reload'.split(), check=True)
-        subprocess.run('systemctl enable {}'.format(service_name).split(), check=True)
+            ostream.write(service_def)
+        subprocess.run(['systemctl', 'daemon-reload'], check=True)
+        subprocess.run(['systemctl', 'enable', service_name], check=True)
         return None, None
     except Exception as e:
-        return None, 'Failed to install [{}]: {}'.format(service_name, e)
+        return None, f'Failed to install [{service_name}]: {e}'
 
 
 def systemd_uninstall(service_name):
     systemd_path = systemd_service_path(service_name)
     try:
-        if os.path.exists(systemd_path):
-            subprocess.run('systemctl stop {}'.format(service_name).split(), check=True)
-            subprocess.run('systemctl disable {}'.format(service_name).split(), check=True)
-            os.remove(systemd_path)
+        # stop and disable in one systemctl call
+        job = subprocess.run(['systemctl', 'disable', '--now', service_name], stderr=subprocess.PIPE)
+        if job.returncode != 0:
+            if not os.path.exists(systemd_path):
+                # service is not installed, nothing to do
+                return None, None
+            details = job.stderr.decode('utf-8', 'replace').strip()
+            return None, f'Failed to uninstall [{service_name}]: {details}'
+        os.remove(systemd_path)
         return None, None
     except FileNotFoundError:
         return None, None
     except Exception as e:
-        return None, 'Failed to uninstall [{}]: {}'.format(service_name, e)
+        return None, f'Failed to uninstall [{service_name}]: {e}'
 
 
-WAIT_FOR_STARTUP = 2.0  # second(s)
+WAIT_FOR_STARTUP = 30.0  # second(s)
+STARTUP_POLL_INTERVAL = 0.05  # second(s)
+STARTUP_GRACE_PERIOD = 1.0  # second(s)
 
+UNIT_STATE_PROPERTIES = ('ActiveState', 'SubState', 'ExecMainPID', 'NRestarts')
 
-def systemd_start(service_name):
-    job = subprocess.run('systemctl restart {}'.format(service_name).split())
+
+def systemd_unit_state(service_name):
+    args = ['systemctl', 'show']
+    for name in UNIT_STATE_PROPERTIES:
+        args += ['-p', name]
+    job = subprocess.run([*args, service_name], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     if job.returncode != 0:
-        return None, 'Failed to start service: {}'.format(service_name)
-    time.sleep(WAIT_FOR_STARTUP)
-    job = subprocess.run('systemctl -q status {}'.format(service_name).split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return None
+    lines = job.stdout.decode('utf-8', 'replace').splitlines()
+    return dict(line.split('=', 1) for line in lines if '=' in line)
+
+
+def systemd_wait_started(service_name):
+    # systemctl restart already blocks until its job is removed,
+    # so only services still activating need to be waited for
+    deadline = time.monotonic() + WAIT_FOR_STARTUP
+    while True:
+        state = systemd_unit_state(service_name)
+        if state is None or state.get('SubState') == 'auto-restart':
+            return False
+        if state.get('ActiveState') not in ('activating', 'reloading') or time.monotonic() >= deadline:
+            break
+        time.sleep(STARTUP_POLL_INTERVAL)
+    if state.get('ActiveState') != 'active':
+        return False
+    # Type=simple units become active as soon as process is spawned,
+    # so check that main process survives grace period without restarts
+    time.sleep(STARTUP_GRACE_PERIOD)
+    return systemd_unit_state(service_name) == state
+
+
+def systemd_start(service_name):
+    job = subprocess.run(['systemctl', 'restart', service_name])
     if job.returncode != 0:
+        return None, f'Failed to start service: {service_name}'
+    if not systemd_wait_started(service_name):
         # TODO: inconsistent behavior: service remains enabled
-        subprocess.run('systemctl stop {}'.format(service_name).split())
-        return None, 'Failed to get service status: {}'.format(service_name)
+        subprocess.run(['systemctl', 'stop', service_name])
+        return None, f'Failed to get service status: {service_name}'
     return None, None
 
 
 def systemd_stop(service_name):
-    job = subprocess.run('systemctl stop {}'.format(service_name).split())
+    job = subprocess.run(['systemctl', 'stop', service_name])
     if job.returncode != 0:
-        return None, 'Failed to stop service: {}'.format(service_name)
+        return None, f'Failed to stop service: {service_name}'
     return None, None
 
 
 def copy_files(srcdir, dstdir):
     shutil.rmtree(dstdir, ignore_errors=True)
-    os.makedirs(dstdir)
     if not os.path.exists(srcdir):
-        return None, 'Source directory not exists: {}'.format(srcdir)
-    job = subprocess.run('rsync -r {}/ {}'.format(srcdir, dstdir).split())
-    if job.returncode != 0:
-        return None, 'Failed to copy files'
+        os.makedirs(dstdir)
+        return None, f'Source directory not exists: {srcdir}'
+    try:
+        # copytree creates dstdir itself
+        shutil.copytree(srcdir, dstdir, copy_function=shutil.copy2)
+    except Exception as e:
+        return None, f'Failed to copy files: {e}'
     return None, None
 
 
-@click.group()
-def cli():
-    """Tool for service control"""
-    pass
+COMMANDS = []
+
+
+def command(*arguments, variadic=None, short_help=None):
+    """Register function as CLI command taking positional arguments"""
+    def register(func):
+        COMMANDS.append((func, arguments, variadic, short_help))
+        return func
+    return register
 
 
-@cli.command()
-@click.argument('service')
-@click.argument('config')
+def cli():
+    """Tool for service control"""
+    parser = argparse.ArgumentParser(description=cli.__doc__)
+    subparsers = parser.add_subparsers(dest='command', metavar='COMMAND')
+    subparsers.required = True
+    for func, arguments, variadic, short_help in COMMANDS:
+        subparser = subparsers.add_parser(
+            func.__name__,
+            help=short_help or func.__doc__,
+            description=func.__doc__,
+        )
+        for name in arguments:
+            subparser.add_argument(name, metavar=name.upper())
+        if variadic:
+            subparser.add_argument(variadic, metavar=variadic.upper(), nargs=argparse.REMAINDER)
+        subparser.set_defaults(handler=func)
+    options = vars(parser.parse_args())
+    del options['command']
+    handler = options.pop('handler')
+    handler(**options)
+
+
+@command('service', 'config')
 def install(service, config):
     """Install systemd service"""
-    print('Setting up service [{}] for config [{}]...'.format(service, config))
+    print(f'Setting up service [{service}] for config [{config}]...')
     settings, error = load_settings(service, config)
     if error is not None:
         print_error(error)
         sys.exit(1)
     if service in ('webapp',):
-        settings['GUNICORN_CMD'] = os.path.join(os.path.dirname(settings['PYTHON_CMD']), 'gunicorn')
-        settings['GUNICORN_CONFIG_PATH'] = os.path.join(settings['HOME'], 'services', 'gunicorn_config.py')
-        service_template_path = os.path.join('services', 'templates', 'systemd.gunicorn.service')
-        service_def = render_template(service_template_path, settings)
+        settings['GUNICORN_CMD'] = os.path.join(PYTHON_BINDIR, 'gunicorn')
+        settings['GUNICORN_CONFIG_PATH'] = GUNICORN_CONFIG_PATH
+        service_def = render_template(GUNICORN_TEMPLATE_PATH, settings)
         targetroot = settings['targetroot']
         __, error = copy_files(os.path.join(HERE, 'project_static'), targetroot)
         if error is not None:
             print_error(error)
             sys.exit(1)
     elif service in ('taskplanner', 'taskworker'):
-        settings['CELERY_CMD'] = os.path.join(os.path.dirname(settings['PYTHON_CMD']), 'celery')
-        service_template_path = os.path.join('services', 'templates', 'systemd.celery.service')
-        service_def = render_template(service_template_path, settings)
+        settings['CELERY_CMD'] = os.path.join(PYTHON_BINDIR, 'celery')
+        service_def = render_template(CELERY_TEMPLATE_PATH, settings)
     else:
-        print_error('Unsupported service: {}'.format(service))
+        print_error(f'Unsupported service: {service}')
         sys.exit(1)
         # service_template_path = os.path.join('services', 'templates', 'systemd.run.service')
         # service_def = render_template(service_template_path, settings)
@@ -175,12 +330,20 @@ def install(service, config):
     print('Service installed:', systemd_name)
 
 
-@cli.command()
-@click.argument('service')
-@click.argument('config')
+@command('service', 'config')
+def has(service, config):
+    """Check that service config is defined"""
+    __, error = peek_descriptor(service, config)
+    if error is not None:
+        print_error(error)
+        sys.exit(1)
+    print(f'Config found: [{config}] for service [{service}]')
+
+
+@command('service', 'config')
 def uninstall(service, config):
     """Uninstall systemd service"""
-    print('Removing service [{}] for config [{}]...'.format(service, config))
+    print(f'Removing service [{service}] for config [{config}]...')
     systemd_name = derive_systemd_name(service, config)
     __, error = systemd_uninstall(systemd_name)
     if error is not None:
@@ -189,12 +352,10 @@ def uninstall(service, config):
     print('Service uninstalled:', systemd_name)
 
 
-@cli.command()
-@click.argument('service')
-@click.argument('config')
+@command('service', 'config')
 def start(service, config):
     """Start systemd service"""
-    print('Starting service [{}] for config [{}]...'.format(service, config))
+    print(f'Starting service [{service}] for config [{config}]...')
     systemd_name = derive_systemd_name(service, config)
     __, error = systemd_start(systemd_name)
     if error is not None:
@@ -203,12 +364,10 @@ def start(service, config):
     print('Service started:', systemd_name)
 
 
-@cli.command()
-@click.argument('service')
-@click.argument('config')
+@command('service', 'config')
 def stop(service, config):
     """Stop systemd service"""
-    print('Stopping service [{}] for config [{}]...'.format(service, config))
+    print(f'Stopping service [{service}] for config [{config}]...')
     systemd_name = derive_systemd_name(service, config)
     __, error = systemd_stop(systemd_name)
     if error is not None:
@@ -218,22 +377,39 @@ def stop(service, config):
 
 
 def guess_and_fix_command(cmdline):
-    args = cmdline.split()
+    args = shlex.split(cmdline)
     first_arg = args[0]
     if first_arg.endswith('.py'):
-        return '{} {}'.format(sys.executable, ' '.join(args))
-    pythondir = os.path.abspath(os.path.dirname(sys.executable))
-    possible_executable_name = os.path.join(pythondir, first_arg)
+        return [sys.executable, *args]
+    possible_executable_name = os.path.join(PYTHON_BINDIR, first_arg)
     if os.path.exists(possible_executable_name):
-        return '{} {}'.format(possible_executable_name, ' '.join(args[1:]))
-    return cmdline
+        return [possible_executable_name, *args[1:]]
+    return args
+
+
+def job_environment(settings):
+    service_env = settings.get('env')
+    if not service_env:
+        # child inherits parent environment as is
+        return None
+    return {**os.environ, **{k: str(v) for k, v in service_env.items()}}
+
+
+def exec_command(argv, env):
+    # replace current process, so command exit status becomes ours
+    try:
+        if env is None:
+            os.execvp(argv[0], argv)
+        else:
+            os.execvpe(argv[0], argv, env)
+    except OSError as e:
+        print_error(f'Failed to run command [{argv[0]}]: {e}')
+        sys.exit(1)
 
 
-@cli.command(short_help='Run as foreground child process')
-@click.argument('service')
-@click.argument('config')
+@command('service', 'config', short_help='Run in foreground')
 def run(service, config):
-    """Run as foreground child process (convenient for development)"""
+    """Run in foreground in place of this process (convenient for development)"""
 
     settings, error = load_settings(service, config)
     if error is not None:
@@ -246,20 +422,10 @@ def run(service, config):
         sys.exit(1)
 
     run_command = guess_and_fix_command(run_command_args)
-
-    job_env = os.environ.copy()
-    job_env.update({k: str(v) for k, v in settings['env'].items()})
-    job = subprocess.run(run_command.split(), env=job_env)
-    if job.returncode != 0:
-        print_error('Service stopped with return code:', job.returncode)
-        sys.exit(1)
+    exec_command(run_command, job_environment(settings))
 
 
-@cli.command(short_help='Run command for service')
-@click.argument('service')
-@click.argument('config')
-@click.argument('action')
-@click.argument('args', nargs=-1)
+@command('service', 'config', 'action', variadic='args', short_help='Run command for service')
 def do(service, config, action, args):
     """Run service command"""
 
@@ -274,18 +440,11 @@ def do(service, config, action, args):
 
     action_command_base_args = settings['actions'].get(action)
     if not action_command_base_args:
-        print_error('Settings do not have action [{}] command specified'.format(action))
+        print_error(f'Settings do not have action [{action}] command specified')
         sys.exit(1)
 
-    action_command_args = '{} {}'.format(action_command_base_args, ' '.join(args))
-    action_command = guess_and_fix_command(action_command_args)
-
-    job_env = os.environ.copy()
-    job_env.update({k: str(v) for k, v in settings['env'].items()})
-    job = subprocess.run(action_command.split(), env=job_env)
-    if job.returncode != 0:
-        print_error('Command stopped with return code:', job.returncode)
-        sys.exit(1)
+    action_command = guess_and_fix_command(action_command_base_args) + list(args)
+    exec_command(action_command, job_environment(settings))
 
 
 if __name__ == '__main__':